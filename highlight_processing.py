@@ -2,15 +2,64 @@
 This module contains classes and functions for processing and parsing highlights from Kindle books.
 """
 
-from validations import check_single_match, check_text_format
-from typing import Tuple, List, Literal, Dict, Any
+from validations import check_text_format, ParsingError
+from typing import Tuple, List, Literal, Dict, Any, Iterator, Optional, Pattern, Callable
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 import re
 import pandas as pd
 from datetime import datetime
 import logging
 import json
-from utils import read_file_content
-
+import sys
+import os
+from utils import iter_file_records
+
+_MONTHS = {
+    'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6,
+    'July': 7, 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12
+}
+
+# 'Month day, year hour:minutes:seconds AM|PM', with every field captured so
+# the date can be built without datetime.strptime
+_DATE_PATTERN = (rf"(?P<month>{'|'.join(_MONTHS)})\s+(?P<day>\d{{1,2}}),\s+(?P<year>\d{{4}})"
+                 r"\s+(?P<hour>\d{1,2}):(?P<minute>\d{2}):(?P<second>\d{2})\s+(?P<meridiem>AM|PM)")
+
+_DATE_RE = re.compile(rf"\b{_DATE_PATTERN}\b")
+# Either 'page N[-M]' or a bare 'N-M' range, whichever comes first
+_PAGES_RE = re.compile(r'(?:page\s+|(?=\d+-\d))(\d+)(?:-(\d+))?')
+_TITLE_AUTHOR_RE = re.compile(r'[^\n]* by [^\n]*')
+
+# Date and pages of a details line in a single anchored scan, e.g.
+# '- Your Highlight on page 12-13 | Location 180-181 | Added on Sunday, March 31, 2024 6:48:47 PM'
+# The pages are only looked for in the first '|' separated segment, which bounds the backtracking.
+_DETAILS_RE = re.compile(rf"[^|]*?\bpage\s+(?P<start_page>\d+)(?:-(?P<end_page>\d+))?\b[^|]*\|.*?\b{_DATE_PATTERN}\b")
+
+# The line boundaries of str.splitlines besides '\n'
+_OTHER_LINE_BOUNDARIES_RE = re.compile('[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+# Separator placed after every quote. It never changes, so the same
+# dict is shared by all the blocks built and must not be modified.
+_EMPTY_PARAGRAPH_BLOCK = {
+    "object": "block",
+    "type": "paragraph",
+    "paragraph": {
+        "rich_text": [
+            {
+                "type": "text",
+                "text": {
+                    "content": "",
+                    "link": None
+                }
+            }
+        ]
+    }
+}
+
+@dataclass(slots=True, eq=False)
 class Highlight():
     """
     Represents a highlighted section from a document.
@@ -23,24 +72,11 @@ class Highlight():
         author (str, optional): The author of the document. Defaults to None.
     """
 
-
-    def __init__(self, document_name:str, date:datetime, pages:Tuple[int], content:str, author=None) -> None:
-        """
-        Initializes a Highlight object.
-
-        Args:
-            document_name (str): The name of the document.
-            date (datetime): The date the highlight was made.
-            pages (Tuple[int]): A tuple representing the start and end pages of the highlight.
-            content (str): The content of the highlight.
-            author (str, optional): The author of the document. Defaults to None.
-        """
-        
-        self.document_name = document_name
-        self.date = date
-        self.pages = pages
-        self.content = content
-        self.author = author
+    document_name: str
+    date: datetime
+    pages: Tuple[int, int]
+    content: str
+    author: Optional[str] = None
 
     def __str__(self) -> str:
         """
@@ -91,21 +127,7 @@ class Highlight():
                                 "color": "default"
                             }
                         },
-                        {
-                            "object": "block",
-                            "type": "paragraph",
-                            "paragraph": {
-                                "rich_text": [
-                                    {
-                                        "type": "text",
-                                        "text": {
-                                            "content": "",
-                                            "link": None
-                                        }
-                                    }
-                                ]
-                            }
-                        }
+                        _EMPTY_PARAGRAPH_BLOCK
                     ]
 
             case _:
@@ -120,10 +142,14 @@ class HighlightParser():
     A class for parsing highlight details from raw text.
     """
 
+    @lru_cache(maxsize=None)
     def _parse_title_and_author(text:str) -> Tuple[str]:
         """
         Parses the title and author from the given text.
 
+        Results are cached, as every highlight from the same document shares the same text, and the
+        returned strings are interned.
+
         Expects the following format :
             - 'Title by author.extension'
 
@@ -137,15 +163,37 @@ class HighlightParser():
             ParsingError: If the text does not match the expected format.
         """
 
-        pattern = r'^.* by .*$'
+        check_text_format(text_to_check=text, expected_pattern=_TITLE_AUTHOR_RE)
+
+        content, _, _ = text.partition('.')
+
+        title, separator, author = content.partition(' by ')
+
+        if not separator:
+            raise ParsingError(f'{text} does not contain a title and an author separated by " by "')
+
+        # Interned, so documents whose names only differ in their extension still share the same strings
+        return sys.intern(title.strip()), sys.intern(author.strip())
+
+    def _build_date(match:re.Match) -> datetime:
+        """
+        Builds the date captured by a match of the date pattern.
+
+        Equivalent to `datetime.strptime(date_string, "%B %d, %Y %I:%M:%S %p")` on the matched text.
 
-        check_text_format(text_to_check=text, expected_pattern=pattern)
+        Args:
+            match (re.Match): A match exposing the month, day, year, hour, minute, second and meridiem groups.
 
-        content, *extension = text.split('.')
+        Returns:
+            datetime: The date captured by the match.
+        """
+
+        hour = int(match['hour']) % 12
 
-        title, author = content.split('by')
+        if match['meridiem'] == 'PM':
+            hour += 12
 
-        return title.strip(), author.strip()
+        return datetime(int(match['year']), _MONTHS[match['month']], int(match['day']), hour, int(match['minute']), int(match['second']))
 
     def _parse_date(text:str) -> datetime:
         """
@@ -165,14 +213,12 @@ class HighlightParser():
             ParsingError: If no date in the format 'Month date year' is found within the text
         """
 
-        date_pattern = r"\b(?:January|February|March|April|May|June|July|August|September|October|November|December)\s+\d{1,2},\s+\d{4}\s+\d{1,2}:\d{2}:\d{2}\s+(?:AM|PM)\b"
-        matches = re.findall(date_pattern, text)
+        match = _DATE_RE.search(text)
 
-        date_string = check_single_match(matches=matches, 
-                                       msg_no_matches='Text must contain a date',
-                                       msg_more_than_one_match='Text can only contain a single date')
+        if match is None:
+            raise ValueError('Text must contain a date')
 
-        return datetime.strptime(date_string, "%B %d, %Y %I:%M:%S %p")
+        return HighlightParser._build_date(match)
 
 
     def _parse_pages(text:str) -> Tuple[int]:
@@ -192,22 +238,89 @@ class HighlightParser():
         Raises:
             ParsingError: If no pages in the format 'digit' or 'digits-digits' is found
         """
-        pattern = r'(\d+-\d+)'
-        matches = re.findall(pattern, text)
+        match = _PAGES_RE.search(text)
+
+        if match is None:
+            raise ValueError('No pages found')
+
+        start_page, end_page = match.groups()
+
+        return int(start_page), int(end_page or start_page)
+
+    def _parse_details(text:str) -> Tuple[datetime, Tuple[int]]:
+        """
+        Parses the date and the pages from the details line of a highlight.
+
+        Both fields are extracted with a single regex scan. Lines that do not follow the
+        'page ... date' layout fall back to `_parse_date` and `_parse_pages`.
+
+        Args:
+            text (str): The details line of the highlight.
+
+        Returns:
+            Tuple[datetime, Tuple[int]]: The parsed date and the start and end pages.
+
+        Raises:
+            ParsingError: If the date or the pages can not be found within the text
+        """
+
+        match = _DETAILS_RE.match(text)
+
+        if match is None:
+            return HighlightParser._parse_date(text), HighlightParser._parse_pages(text)
+
+        date = HighlightParser._build_date(match)
+
+        start_page = int(match['start_page'])
+        end_page = int(match['end_page']) if match['end_page'] else start_page
+
+        return date, (start_page, end_page)
+
+    def _parse_fields(raw_text:str) -> Tuple[str, str, datetime, Tuple[int], str]:
+        """
+        Parses the fields of a highlight from raw text.
+
+        Args:
+            raw_text (str): The raw text containing highlight details, already stripped of
+                leading and trailing whitespace.
+
+        Returns:
+            Tuple[str, str, datetime, Tuple[int], str]: The title, author, date, pages and content of the highlight.
+        """
+
+        # Line boundaries other than '\n' are rare, the text is then split as a whole to handle them all
+        if _OTHER_LINE_BOUNDARIES_RE.search(raw_text):
 
-        try: 
+            lines = raw_text.splitlines()
 
-            pages = check_single_match(matches=matches, msg_more_than_one_match='Too many pages to parse', msg_no_matches='No pages found')
-            start_page, end_page = pages.split('-')
+            if len(lines) < 2:
+                raise ValueError('Highlight must contain a document name and a details line')
+
+            raw_document_name, details, *content_lines = lines
+            content = ''.join(content_lines)
+
+        else:
 
-        except ValueError:
+            # The first two lines hold the document name and the details, the rest is the content.
+            # Slicing around the first two line breaks avoids splitting every line of the content.
+            first_break = raw_text.find('\n')
 
-            pattern = r'page (\d+)'
-            matches = re.findall(pattern, text)
-            page = check_single_match(matches=matches, msg_more_than_one_match='Too many pages to parse', msg_no_matches='No pages found')
-            start_page, end_page = page, page
+            if first_break == -1:
+                raise ValueError('Highlight must contain a document name and a details line')
+
+            second_break = raw_text.find('\n', first_break + 1)
+
+            if second_break == -1:
+                second_break = len(raw_text)
+
+            raw_document_name = raw_text[:first_break]
+            details = raw_text[first_break + 1:second_break]
+            content = raw_text[second_break + 1:].replace('\n', '')
+
+        date, pages = HighlightParser._parse_details(details)
+        title, author = HighlightParser._parse_title_and_author(raw_document_name)
 
-        return int(start_page), int(end_page)
+        return title, author, date, pages, content
 
     @staticmethod
     def from_text(raw_text:str) -> Highlight:
@@ -215,122 +328,328 @@ class HighlightParser():
         Creates a Highlight object from raw text.
 
         Args:
-            raw_text (str): The raw text containing highlight details.
+            raw_text (str): The raw text containing highlight details, already stripped of
+                leading and trailing whitespace.
 
         Returns:
             Highlight: A Highlight object created from the raw text.
         """
 
-        raw_text = raw_text.strip()
-        raw_document_name, details, *content = raw_text.splitlines()
+        title, author, date, pages, content = HighlightParser._parse_fields(raw_text)
 
+        return Highlight(document_name =title, date=date, pages=pages, content = content, author=author)
 
-        date = HighlightParser._parse_date(details)
-        title, author = HighlightParser._parse_title_and_author(raw_document_name)
-        pages = HighlightParser._parse_pages(details)
+    @staticmethod
+    def from_text_to_columns(raw_text:str, columns:Dict[str, List[Any]]) -> None:
+        """
+        Parses a highlight from raw text and appends its fields to table columns, along with whether it is a vocabulary word.
 
-        return Highlight(document_name =title, date=date, pages=pages, content = ''.join(content), author=author)
+        Used when building a table, as it skips creating a Highlight object for every row.
+
+        Args:
+            raw_text (str): The raw text containing highlight details, already stripped of
+                leading and trailing whitespace.
+            columns (Dict[str, List[Any]]): The columns of the table, as created by `_new_columns`.
+        """
+
+        title, author, date, (start_page, end_page), content = HighlightParser._parse_fields(raw_text)
+
+        columns['document_name'].append(title)
+        columns['date'].append(date)
+        columns['start_page'].append(start_page)
+        columns['end_page'].append(end_page)
+        columns['content'].append(content)
+        columns['author'].append(author)
+        # A single word once stripped, i.e. no space left in it
+        columns['is_vocabulary'].append(' ' not in content.strip())
     
 
+# Number of raw highlights sent at once to each worker process
+_PARSE_BATCH_SIZE = 512
+
+# Number of batches submitted ahead for each worker process, bounding the highlights held in memory
+_PENDING_BATCHES_PER_WORKER = 2
+
+def _map_batches(fn:Callable[[List[str]], Any], batches:Iterator[List[str]], max_workers:int) -> Iterator[Any]:
+    """
+    Applies a function to batches of raw highlights in a pool of processes.
+
+    Unlike `ProcessPoolExecutor.map`, which submits every batch before returning the first result,
+    the batches are read from `batches` only as results are consumed, with at most
+    `_PENDING_BATCHES_PER_WORKER` batches per worker submitted ahead.
+
+    Args:
+        fn (Callable[[List[str]], Any]): The function parsing a batch, defined at module level.
+        batches (Iterator[List[str]]): The batches of raw highlights.
+        max_workers (int): The number of processes parsing the batches.
+
+    Yields:
+        Any: The result of each batch, in the same order as the batches.
+    """
+
+    max_pending = _PENDING_BATCHES_PER_WORKER * max_workers
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        pending = deque()
+
+        for batch in batches:
+
+            pending.append(executor.submit(fn, batch))
+
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def _parse_batch(raw_highlights:List[str]) -> List[Highlight]:
+    """
+    Parses a batch of raw highlights.
+
+    Defined at module level so it can be sent to the worker processes of `HighlightFileProcessor.iter_highlights`.
+
+    Args:
+        raw_highlights (List[str]): The raw texts of the highlights.
+
+    Returns:
+        List[Highlight]: The Highlight objects parsed from the batch, in the same order.
+    """
+
+    return [HighlightParser.from_text(raw_highlight) for raw_highlight in raw_highlights]
+
+def _new_columns() -> Dict[str, List[Any]]:
+    """
+    Creates the empty columns of a highlights table.
+
+    Returns:
+        Dict[str, List[Any]]: An empty list for each column of the table.
+    """
+
+    return dict(document_name=[], date=[], start_page=[], end_page=[], content=[], author=[], is_vocabulary=[])
+
+def _parse_batch_to_columns(raw_highlights:List[str]) -> Dict[str, List[Any]]:
+    """
+    Parses a batch of raw highlights into table columns.
+
+    Defined at module level so it can be sent to the worker processes of `HighlightFileProcessor.convert_to_table`.
+
+    Args:
+        raw_highlights (List[str]): The raw texts of the highlights.
+
+    Returns:
+        Dict[str, List[Any]]: The columns holding the fields of the highlights, in the same order.
+    """
+
+    columns = _new_columns()
+
+    for raw_highlight in raw_highlights:
+        HighlightParser.from_text_to_columns(raw_highlight, columns)
+
+    return columns
+
+
 class HighlightFileProcessor:
     """
     A class for processing highlight files and converting them to a table.
     """
 
     @staticmethod
-    def _update_book_titles(prev_file_contents:str, updated_titles:Dict[str, str]) -> str:
+    def _compile_titles_pattern(updated_titles:Dict[str, str]) -> Optional[Pattern[str]]:
+        """
+        Compiles a single regex matching any of the titles to update.
+
+        Longer titles are tried first, so a title is not shadowed by another title it contains.
+
+        Args:
+            updated_titles (Dict[str, str]): A dictionary mapping old titles to new titles.
+
+        Returns:
+            re.Pattern or None: The compiled pattern, or None if there are no titles to update.
+        """
+
+        if not updated_titles:
+            return None
+
+        old_titles = sorted(updated_titles, key=len, reverse=True)
+
+        return re.compile('|'.join(map(re.escape, old_titles)))
+
+    @staticmethod
+    def _update_book_titles(prev_file_contents:str, updated_titles:Dict[str, str], titles_pattern:Optional[Pattern[str]]) -> str:
         """
         Updates the book titles in the file contents based on a dictionary of updated titles.
 
+        All the titles are replaced in a single scan of the contents.
+
         Args:
             prev_file_contents (str): The previous file contents.
             updated_titles (Dict[str, str]): A dictionary mapping old titles to new titles.
+            titles_pattern (re.Pattern or None): The pattern built by `_compile_titles_pattern` from `updated_titles`.
 
         Returns:
             str: The updated file contents with the titles replaced.
         """
-        new_file_content = prev_file_contents
-
-        for old_title, updated_title in updated_titles.items():
 
-            new_file_content = new_file_content.replace(old_title, updated_title)
+        if titles_pattern is None:
+            return prev_file_contents
 
-        return new_file_content
+        return titles_pattern.sub(lambda match: updated_titles[match.group(0)], prev_file_contents)
 
     @staticmethod
-    def process_highlights_file(filename:str) -> List[Highlight]:
+    @lru_cache(maxsize=4)
+    def _load_updated_titles(filename:str, mtime:float) -> Tuple[Dict[str, str], Optional[Pattern[str]]]:
         """
-        Processes a highlight file and returns a list of Highlight objects.
+        Loads the titles to update from a JSON file, along with the pattern matching them.
+
+        Results are cached on the filename and its modification time, so the file is only read
+        again once it changes.
 
         Args:
-            filename (str): The name of the highlight file.
+            filename (str): The name of the JSON file mapping old titles to new titles.
+            mtime (float): The modification time of the file.
 
         Returns:
-            List[Highlight]: A list of Highlight objects parsed from the file.
+            Tuple[Dict[str, str], re.Pattern or None]: The titles to update and the pattern built by `_compile_titles_pattern`.
         """
 
-        file_content = read_file_content(filename)
+        with open(filename, 'r') as json_file:
+            updated_titles = json.load(json_file)
 
-        # Replace the titles specified in the updated_titles.json file
+        return updated_titles, HighlightFileProcessor._compile_titles_pattern(updated_titles)
 
-        with open('updated_titles.json', 'r') as json_file:
-            updated_titles = json.load(json_file)
+    @staticmethod
+    def _iter_raw_highlights(filename:str) -> Iterator[str]:
+        """
+        Lazily reads the non empty raw highlights of a file, with their titles updated.
+
+        Args:
+            filename (str): The name of the highlight file.
+
+        Yields:
+            str: The raw text of each highlight, stripped, in file order.
+        """
 
-        file_content = HighlightFileProcessor._update_book_titles(prev_file_contents=file_content, updated_titles=updated_titles)
+        titles_filename = 'updated_titles.json'
 
-        raw_highlights =  file_content.split('==========')
+        updated_titles, titles_pattern = HighlightFileProcessor._load_updated_titles(titles_filename, os.path.getmtime(titles_filename))
 
-        output = []
+        for raw_highlight in iter_file_records(filename, delimiter='=========='):
 
-        for highlight in raw_highlights:
+            raw_highlight = raw_highlight.strip()
 
             # Only parse non empty highlights
-            if len(highlight.strip())==0:
+            if not raw_highlight:
                 continue
 
-            highlight_processed  = HighlightParser.from_text(highlight)
+            # Replace the titles specified in the updated_titles.json file
+            yield HighlightFileProcessor._update_book_titles(prev_file_contents=raw_highlight, updated_titles=updated_titles, titles_pattern=titles_pattern)
 
-            output.append(highlight_processed)
+    @staticmethod
+    def _iter_batches(raw_highlights:Iterator[str]) -> Iterator[List[str]]:
+        """
+        Groups raw highlights into batches of `_PARSE_BATCH_SIZE` to send to worker processes.
+
+        Args:
+            raw_highlights (Iterator[str]): The raw texts of the highlights.
+
+        Returns:
+            Iterator[List[str]]: The consecutive batches of raw highlights, the last one possibly shorter.
+        """
+
+        return iter(lambda: list(islice(raw_highlights, _PARSE_BATCH_SIZE)), [])
+
+    @staticmethod
+    def iter_highlights(filename:str, max_workers:int = 1) -> Iterator[Highlight]:
+        """
+        Lazily parses a highlight file, yielding one Highlight object at a time.
+
+        The file is streamed record by record, so it is never held in memory as a whole.
+        With more than one worker, the records are instead read in batches of `_PARSE_BATCH_SIZE`
+        and parsed in a pool of processes, with only a few batches per worker read ahead.
+
+        Args:
+            filename (str): The name of the highlight file.
+            max_workers (int, optional): The number of processes parsing the highlights. Defaults to 1,
+                which parses them in the current process.
+
+        Yields:
+            Highlight: The Highlight objects parsed from the file, in file order.
+        """
+
+        raw_highlights = HighlightFileProcessor._iter_raw_highlights(filename)
+
+        if max_workers <= 1:
+
+            for raw_highlight in raw_highlights:
+                yield HighlightParser.from_text(raw_highlight)
+
+        else:
+
+            batches = HighlightFileProcessor._iter_batches(raw_highlights)
+
+            for parsed_batch in _map_batches(_parse_batch, batches, max_workers):
+                yield from parsed_batch
 
         logging.info(f'{filename} processed')
 
-        return output
+    @staticmethod
+    def process_highlights_file(filename:str, max_workers:int = 1) -> List[Highlight]:
+        """
+        Processes a highlight file and returns a list of Highlight objects.
+
+        Args:
+            filename (str): The name of the highlight file.
+            max_workers (int, optional): The number of processes parsing the highlights. Defaults to 1.
+
+        Returns:
+            List[Highlight]: A list of Highlight objects parsed from the file.
+        """
+
+        return list(HighlightFileProcessor.iter_highlights(filename, max_workers=max_workers))
 
     @staticmethod
-    def convert_to_table(filename:str) -> pd.DataFrame:
+    def convert_to_table(filename:str, max_workers:int = 1) -> pd.DataFrame:
         """
         Converts the highlights from a file into a Pandas DataFrame.
 
         Args:
             filename (str): The name of the highlight file.
+            max_workers (int, optional): The number of processes parsing the highlights. Defaults to 1.
 
         Returns:
             pd.DataFrame: A DataFrame containing the parsed highlight information.
         """
 
+        # Built column by column, straight from the raw highlights
+        columns = _new_columns()
+
         try:
-            all_parsed_highlights = HighlightFileProcessor.process_highlights_file(filename)
-        except Exception as e:
-            logging.error(f'Error {e} raise while processing {filename}.')
-            raise e
+            raw_highlights = HighlightFileProcessor._iter_raw_highlights(filename)
 
-        rows = []
+            if max_workers <= 1:
 
-        for h in all_parsed_highlights:
+                for raw_highlight in raw_highlights:
+                    HighlightParser.from_text_to_columns(raw_highlight, columns)
 
-            start_page, end_page = h.pages
+            else:
 
-            new_row = dict(document_name=h.document_name, date=h.date, start_page=start_page, end_page=end_page, content=h.content, author=h.author)
+                batches = HighlightFileProcessor._iter_batches(raw_highlights)
 
-            rows.append(new_row)
+                for batch_columns in _map_batches(_parse_batch_to_columns, batches, max_workers):
+                    for column_name, values in batch_columns.items():
+                        columns[column_name].extend(values)
 
-        output = pd.DataFrame(rows)
+        except Exception as e:
+            logging.error(f'Error {e} raise while processing {filename}.')
+            raise e
 
-        get_num_words = lambda text : len(text.strip().split(' '))
+        logging.info(f'{filename} processed')
 
-        is_vocabulary = [get_num_words(content)==1 for content in output['content']]
+        output = pd.DataFrame(columns)
 
-        output['is_vocabulary'] = is_vocabulary
+        # Bool dtype, also for the empty column of a file without highlights
+        output['is_vocabulary'] = output['is_vocabulary'].astype(bool)
 
         return output
     
@@ -3,10 +3,98 @@ This module contains functions for interacting with the Notion API.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from functools import lru_cache
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 import warnings
+import json
 
+class _NotionRetry(Retry):
+    """
+    Retry policy of the requests to the Notion API.
+
+    Rate limited requests (429) were rejected without being applied, so they are retried for every method.
+    A 503 can also be returned once a request times out while its work is done, so it is only retried for
+    GET, as retrying a POST or PATCH could create a page or append blocks twice.
+    """
+
+    def is_retry(self, method:str, status_code:int, has_retry_after:bool = False) -> bool:
+        """
+        Returns whether a response with the given status is retried, never for a 503 to a POST or PATCH.
+
+        Args:
+            method (str): The HTTP method of the request.
+            status_code (int): The status code of the response.
+            has_retry_after (bool, optional): Whether the response has a Retry-After header. Defaults to False.
+
+        Returns:
+            bool: Whether the request is retried.
+        """
+
+        if status_code == 503 and method.upper() != 'GET':
+            return False
+
+        return super().is_retry(method, status_code, has_retry_after=has_retry_after)
+
+# Retried with exponential backoff, honouring Retry-After. Reads are not retried, as a POST or PATCH whose
+# response was lost may already have been applied. Once out of retries, the last response is returned
+# and raise_for_status reports it as before.
+_RETRY = _NotionRetry(
+    total=5,
+    read=0,
+    backoff_factor=1.0,
+    status_forcelist=(429, 503),
+    allowed_methods=frozenset(['GET', 'POST', 'PATCH']),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# Number of blocks the Notion API accepts in the request creating a page
+MAX_CHILDREN_ON_CREATION = 100
+
+# Shared across calls so consecutive requests to the Notion API reuse the same connections
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=_RETRY))
+
+
+def _to_json(payload:Dict[str, Any]) -> bytes:
+    """
+    Serializes a request payload for the Notion API.
+
+    The JSON is written without whitespace between tokens and keeps non ASCII characters as UTF-8,
+    which makes the body of large block uploads noticeably smaller than with `requests`' `json=`.
+
+    Args:
+        payload (Dict[str, Any]): The payload to serialize.
+
+    Returns:
+        bytes: The UTF-8 encoded JSON body.
+    """
+
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False, allow_nan=False).encode('utf-8')
+
+@lru_cache(maxsize=None)
+def _notion_headers(api_key:str, notion_version:str) -> Dict[str, str]:
+    """
+    Returns the headers for a request to the Notion API.
+
+    Built once per API key and version. The returned dict is shared between calls and must not be modified.
+
+    Args:
+        api_key (str): The API key for authentication.
+        notion_version (str): The version of the Notion API.
+
+    Returns:
+        Dict[str, str]: The headers of the request.
+    """
+
+    return {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+        'Notion-Version': notion_version,
+    }
 
 def get_notion_page_info(page_id:str, api_key:str, notion_version:str) -> Dict:
     """
@@ -23,12 +111,9 @@ def get_notion_page_info(page_id:str, api_key:str, notion_version:str) -> Dict:
 
     url = f'https://api.notion.com/v1/pages/{page_id}'
 
-    headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Notion-Version': notion_version,
-        }
+    headers = _notion_headers(api_key, notion_version)
 
-    response = requests.get(url, headers=headers)
+    response = _SESSION.get(url, headers=headers)
 
     response.raise_for_status()
 
@@ -49,12 +134,9 @@ def get_notion_page_contents(page_id:str, api_key:str, notion_version:str) -> Di
 
     url = f'https://api.notion.com/v1/blocks/{page_id}/children'
 
-    headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Notion-Version': notion_version,
-        }
+    headers = _notion_headers(api_key, notion_version)
 
-    response = requests.get(url, headers=headers)
+    response = _SESSION.get(url, headers=headers)
 
     response.raise_for_status()
 
@@ -74,15 +156,11 @@ def append_content_to_page(page_id:str, content:List[Dict[str, Any]], api_key:st
     """
     url = f'https://api.notion.com/v1/blocks/{page_id}/children'
 
-    headers = {
-            'Authorization': f'Bearer {api_key}',
-            "Content-Type":"application/json",
-            'Notion-Version': notion_version,
-        }
+    headers = _notion_headers(api_key, notion_version)
     
     if len(content['children'])<100:
 
-        response = requests.patch(url, headers=headers, json=content)
+        response = _SESSION.patch(url, headers=headers, data=_to_json(content))
 
         response.raise_for_status()
 
@@ -94,7 +172,7 @@ def append_content_to_page(page_id:str, content:List[Dict[str, Any]], api_key:st
 
         batch_size = 100
 
-        for i in range(0, len(all_children)+1, batch_size):
+        for i in range(0, len(all_children), batch_size):
 
             start_idx = i
             end_idx = min(i + batch_size, len(all_children))
@@ -103,7 +181,7 @@ def append_content_to_page(page_id:str, content:List[Dict[str, Any]], api_key:st
 
             batch_content = {'children':batch_children}
 
-            response = requests.patch(url, headers=headers, json=batch_content)
+            response = _SESSION.patch(url, headers=headers, data=_to_json(batch_content))
 
             response.raise_for_status()
 
@@ -123,13 +201,9 @@ def retrieve_database_rows(database_id:str, api_key:str, notion_version:str) ->
 
     url = f'https://api.notion.com/v1/databases/{database_id}/query'
 
-    headers = {
-            'Authorization': f'Bearer {api_key}',
-            "Content-Type":"application/json",
-            'Notion-Version': notion_version,
-        }
+    headers = _notion_headers(api_key, notion_version)
     
-    response = requests.post(url, headers=headers)
+    response = _SESSION.post(url, headers=headers)
     response.raise_for_status()
 
     return response.json()
@@ -148,47 +222,13 @@ def create_new_row_properties(title, author, date, num_highlights) -> Dict[str,
         Dict: A dictionary containing the properties for the new row.
     """
 
-    string_date = datetime.strftime(date, '%Y-%m-%d')
-
-    prop_title = {
-                'title': [
-                    {
-                        'text': {
-                            'content': title
-                        }
-                    }
-                ]
-            }
-    
-    prop_author = {
-                'rich_text': [
-                    {
-                        'text': {
-                            'content': author
-                        }
-                    }
-                ]
-            }
-    
-    prop_date = {
-                'date': {
-                    'start': string_date
-                }
-            }
-    
-    prop_num_highlights = {
-                'number': num_highlights
+    return {
+        'Title': {'title': [{'text': {'content': title}}]},
+        'Author': {'rich_text': [{'text': {'content': author}}]},
+        'Date': {'date': {'start': datetime.strftime(date, '%Y-%m-%d')}},
+        'Number of Highlights': {'number': num_highlights}
     }
 
-    new_properties = {
-        'Title':prop_title,
-        'Author':prop_author,
-        'Date':prop_date,
-        'Number of Highlights':prop_num_highlights
-    }
-
-    return new_properties
-
 def add_book_to_db(
         database_id:str, 
         title:str, 
@@ -196,10 +236,14 @@ def add_book_to_db(
         num_highlights:int, 
         date:datetime, 
         api_key:str, 
-        notion_version:str) -> None:
+        notion_version:str,
+        children:Optional[List[Dict[str, Any]]] = None) -> str:
     """
     Adds a book to a Notion database.
 
+    The blocks in `children` are added to the page of the book when it's created. The Notion API accepts up
+    to `MAX_CHILDREN_ON_CREATION` blocks on creation, further blocks must be appended to the page afterwards.
+
     Args:
         database_id (str): The ID of the Notion database.
         title (str): The title of the book.
@@ -208,23 +252,35 @@ def add_book_to_db(
         date (datetime): The date of the book.
         api_key (str): The API key for authentication.
         notion_version (str): The version of the Notion API.
+        children (List[Dict[str, Any]], optional): The blocks to add to the page of the book. Defaults to None.
+
+    Returns:
+        str: The ID of the Notion page created for the book.
+
+    Raises:
+        ValueError: If there are more than `MAX_CHILDREN_ON_CREATION` blocks in `children`.
     """
     url = 'https://api.notion.com/v1/pages'
 
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'Notion-Version': notion_version,
-    }
+    headers = _notion_headers(api_key, notion_version)
    
     data = {
         'parent': {'database_id': database_id},
         'properties': create_new_row_properties(title, author, date, num_highlights)
     }
-    response = requests.post(url, headers=headers, json=data)
+
+    if children:
+
+        if len(children) > MAX_CHILDREN_ON_CREATION:
+            raise ValueError(f'{len(children)} blocks given, at most {MAX_CHILDREN_ON_CREATION} can be added on creation.')
+
+        data['children'] = children
+
+    response = _SESSION.post(url, headers=headers, data=_to_json(data))
 
     response.raise_for_status()
-    
+
+    return response.json()['id']
 
 def get_books_in_notion_db(database_id:str, api_key:str, notion_version:str) -> List[Dict]:
     """
@@ -236,8 +292,8 @@ def get_books_in_notion_db(database_id:str, api_key:str, notion_version:str) ->
         notion_version (str): The version of the Notion API.
 
     Returns:
-        List[Dict]: A list of dictionaries containing the title and author 
-            of the books and the id from the Notion page associated.
+        List[Dict]: A list of dictionaries containing the title, author and number
+            of highlights of the books and the id from the Notion page associated.
     """
     response = retrieve_database_rows(database_id, api_key=api_key, notion_version=notion_version)
 
@@ -252,8 +308,9 @@ def get_books_in_notion_db(database_id:str, api_key:str, notion_version:str) ->
                 author = None
             else:
                 author = author[0]['text']['content']
+            num_highlights = result['properties']['Number of Highlights']['number']
 
-            output.append({'title':title, 'id':id, 'author':author})
+            output.append({'title':title, 'id':id, 'author':author, 'num_highlights':num_highlights})
 
     else:
         raise NotImplementedError(msg = 'Pagination handling not implemented')
@@ -264,38 +321,37 @@ def update_number_of_highlights(
         page_id: str, 
         highlights_added:int, 
         api_key:str, 
-        notion_version:str
+        notion_version:str,
+        prev_num_highlights:Optional[int] = None
         ) -> None:
     """
     Updates the number of highlights for a book in a Notion database.
 
+    Only the 'Number of Highlights' property is sent, the other properties of the page are left untouched.
+
     Args:
         page_id (str): The ID of the Notion page representing the book.
         highlights_added (int): The number of highlights added.
         api_key (str): The API key for authentication.
         notion_version (str): The version of the Notion API.
+        prev_num_highlights (int, optional): The number of highlights of the book before the update, as
+            returned by `get_books_in_notion_db`. Defaults to None, which retrieves it from the Notion page.
     """
     url = f'https://api.notion.com/v1/pages/{page_id}'
 
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'Notion-Version': notion_version,
-    }
-
-    page_details = get_notion_page_info(page_id=page_id, api_key=api_key, notion_version=notion_version)
+    headers = _notion_headers(api_key, notion_version)
 
-    prev_properties = page_details['properties']
+    if prev_num_highlights is None:
 
-    prev_num_highlights = prev_properties['Number of Highlights']['number']
-    new_num_highlights = highlights_added + prev_num_highlights
+        page_details = get_notion_page_info(page_id=page_id, api_key=api_key, notion_version=notion_version)
 
-    updated_properties = prev_properties
-    updated_properties['Number of Highlights']['number'] = new_num_highlights
+        prev_num_highlights = page_details['properties']['Number of Highlights']['number']
 
     data = {
-        'properties': updated_properties
+        'properties': {
+            'Number of Highlights': {'number': highlights_added + prev_num_highlights}
+        }
     }
 
-    response = requests.patch(url, headers=headers, json=data)
+    response = _SESSION.patch(url, headers=headers, data=_to_json(data))
     response.raise_for_status()
@@ -5,13 +5,17 @@ updating the Notion database, and managing vocabulary.
 
 from highlight_processing import HighlightFileProcessor, Highlight
 from dotenv import load_dotenv
-from integrations import get_books_in_notion_db, add_book_to_db, append_content_to_page, update_number_of_highlights
+from integrations import get_books_in_notion_db, add_book_to_db, append_content_to_page, update_number_of_highlights, MAX_CHILDREN_ON_CREATION
 import os
+import csv
 import logging
 import pandas as pd
-from utils import get_unique_column_value, read_file_content, extract_dates_from_lines
-from typing import Dict, List, Union
+from utils import get_unique_column_value
+from typing import Dict, List, Union, Optional
 from datetime import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from functools import lru_cache
 
 logging.basicConfig(filename='application.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -22,6 +26,41 @@ PAGE_ID = os.getenv('PAGE_ID')
 NOTION_API_KEY = os.getenv('NOTION_API_KEY')
 DATABASE_ID = os.getenv('HIGHLIGHTS_FROM_KINDLE_DB_ID')
 
+# Books uploaded at the same time, kept low to stay close to Notion's rate limit of ~3 requests per second
+MAX_UPLOAD_WORKERS = 3
+
+# Highlights added with the page of a new book, each one being a quote and an empty paragraph block
+HIGHLIGHTS_ON_CREATION = MAX_CHILDREN_ON_CREATION // 2
+
+# Size in bytes of the end of the log read first when looking for the last upload
+_LOG_TAIL_SIZE = 1<<16
+
+_LAST_UPLOAD_RE = re.compile(r'Finished uploading highlights\. Date from last highlight is (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+
+@lru_cache(maxsize=None)
+def get_file_logger(log_file:str) -> logging.Logger:
+    """
+    Returns a logger writing to a log file, configured the first time it's requested.
+
+    Args:
+        log_file (str): The name of the log file.
+
+    Returns:
+        logging.Logger: The logger of the log file.
+    """
+
+    logger = logging.getLogger(f'{__name__}.{log_file}')
+    logger.setLevel(logging.INFO)
+
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+
+    # Messages are only written to the log file, also when it's the one of the root logger
+    logger.propagate = False
+
+    return logger
+
 def log_errors(
         func, 
         log_file,
@@ -29,16 +68,17 @@ def log_errors(
         log_sucessful_message
         ):
 
+    # Configured once, instead of on every call of the wrapped function
+    logger = get_file_logger(log_file)
+
     def wrapper(*args, **kwargs):
         try:
             result = func(*args, **kwargs)
         except Exception as e:
-            logging.basicConfig(filename=log_file, level=logging.ERROR)
-            logging.error(f"{log_error_message} {str(e)}")
+            logger.error(f"{log_error_message} {str(e)}")
             return
         else:
-            logging.basicConfig(filename=log_file, level=logging.INFO)
-            logging.info(log_sucessful_message)
+            logger.info(log_sucessful_message)
             return result
 
     return wrapper
@@ -54,100 +94,224 @@ def parse_last_highlight_date_from_log(log_file_name : str) -> Union[None, datet
         datetime or None: The latest date from a highlight loaded into the database, or None if no highlights were uploaded.
     """
 
-    file_content = read_file_content(filename=log_file_name)
+    # Each upload only adds highlights after the previous one, so the latest date is in the last lines
+    # of the log. These are read in growing windows from the end, until one of them contains an upload.
+    window_size = _LOG_TAIL_SIZE
 
-    if file_content == '':
-        return None
+    with open(log_file_name, 'rb') as log_file:
 
-    line_pattern = 'Finished uploading highlights.'
-    date_pattern = r'Date from last highlight is (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})'
+        log_file.seek(0, os.SEEK_END)
+        log_size = log_file.tell()
 
-    dates_of_update = extract_dates_from_lines(
-        file_content=file_content, 
-        selected_lines_pattern=line_pattern, 
-        date_pattern=date_pattern
-    )
+        while True:
+
+            window_start = max(0, log_size - window_size)
+
+            log_file.seek(window_start)
+            tail = log_file.read(log_size - window_start).decode('utf-8', errors='replace')
 
-    if dates_of_update:
-        return max(dates_of_update)
-    else: 
+            # The first line of a window could be cut
+            if window_start > 0:
+                tail = tail[tail.find('\n') + 1:] if '\n' in tail else ''
+
+            # The window is searched as a whole, the pattern can't match across lines. The dates are
+            # zero padded, so they are compared as text
+            dates_of_update = [match.group(1) for match in _LAST_UPLOAD_RE.finditer(tail)]
+
+            if dates_of_update or window_start == 0:
+                break
+
+            window_size *= 2
+
+    if not dates_of_update:
         return None
 
-def get_missing_books(books_in_db:List[Dict[str,str]], new_highlights:pd.DataFrame)->List[str]:
+    return datetime.strptime(max(dates_of_update), '%Y-%m-%d %H:%M:%S')
+
+def index_books_by_title(books_in_db:List[Dict[str,str]]) -> Dict[str, Dict]:
     """
-    Returns a list of book titles that are not present in the Notion database.
+    Indexes the books in the Notion database by their lowercased title.
+
+    Titles are matched case insensitively. When several books share a title, the first one is kept.
 
     Args:
         books_in_db (List[Dict[str, str]]): A list of dictionaries representing books in the Notion database.
+
+    Returns:
+        Dict[str, Dict]: The books, by their lowercased title.
+    """
+
+    books_by_title = {}
+
+    for book in books_in_db:
+        books_by_title.setdefault(book['title'].lower(), book)
+
+    return books_by_title
+
+def get_missing_books(books_by_title:Dict[str, Dict], new_highlights:pd.DataFrame)->List[str]:
+    """
+    Returns a list of book titles that are not present in the Notion database.
+
+    Args:
+        books_by_title (Dict[str, Dict]): The books in the Notion database, as returned by `index_books_by_title`.
         new_highlights (pd.DataFrame): A DataFrame containing new highlights.
 
     Returns:
         List[str]: A list of book titles that are not present in the Notion database.
     """
 
-    titles_from_books_in_db = [book['title'].lower() for book in books_in_db]
-
-    titles_from_books_to_upload = new_highlights.document_name.unique()
+    titles_from_books_to_upload = new_highlights.document_name.drop_duplicates()
 
-    missing_books = [title for title in titles_from_books_to_upload if title.lower() not in titles_from_books_in_db]
+    missing_books = titles_from_books_to_upload[~titles_from_books_to_upload.str.lower().isin(books_by_title.keys())]
 
-    return missing_books
+    return missing_books.tolist()
 
 
-def add_missing_books_to_db(books_in_db:List[Dict[str,str]], new_highlights:pd.DataFrame) -> None:
+def add_missing_books_to_db(books_by_title:Dict[str, Dict], new_highlights:pd.DataFrame) -> List[Dict]:
     """
-    Adds missing books to the Notion database.
+    Adds missing books to the Notion database, along with their highlights.
 
     Args:
-        books_in_db (List[Dict[str, str]]): A list of dictionaries representing books in the Notion database.
+        books_by_title (Dict[str, Dict]): The books in the Notion database, as returned by `index_books_by_title`.
         new_highlights (pd.DataFrame): A DataFrame containing new highlights.
+
+    Returns:
+        List[Dict]: The books added, with the same keys as the ones returned by `get_books_in_notion_db`.
     """
 
-    missing_books = get_missing_books(books_in_db, new_highlights)
+    missing_books = get_missing_books(books_by_title, new_highlights)
 
-    for title in missing_books:
+    added_books = []
 
-        print(f'Adding {title} to database in Notion...')
+    # Each book is created in its own request, so books are added concurrently
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
 
-        rows_matching_book = new_highlights[(new_highlights.document_name == title) & (~new_highlights.is_vocabulary)]
+        additions = []
 
-        author = get_unique_column_value(rows_matching_book, 'author')
-        date = rows_matching_book.date.min()
-        num_highlights = 0
+        # Grouped once, instead of filtering the whole DataFrame for each book
+        highlights_by_book = new_highlights[~new_highlights.is_vocabulary].groupby('document_name', sort=False)
 
-        add_book_to_db(
-                database_id=DATABASE_ID, 
-                title=title, 
-                author=author, 
-                num_highlights=num_highlights, 
-                date=date, 
-                api_key=NOTION_API_KEY,
-                notion_version=NOTION_VERSION
-            )
+        for title in missing_books:
+
+            print(f'Adding {title} to database in Notion...')
+
+            rows_matching_book = highlights_by_book.get_group(title)
+
+            author = get_unique_column_value(rows_matching_book, 'author')
+            date = rows_matching_book.date.min()
+
+            addition = executor.submit(
+                    add_book_with_highlights,
+                    title=title, 
+                    author=author, 
+                    date=date, 
+                    highlights_from_book=rows_matching_book
+                )
+
+            additions.append((addition, title, author, rows_matching_book))
+
+        # The books are created with their highlights, which a run failing afterwards uploads again. So on the
+        # first failure, the books not started yet are cancelled instead of also being created
+        wait([addition for addition, *_ in additions], return_when=FIRST_EXCEPTION)
+
+        failed_additions = [addition for addition, *_ in additions if addition.done() and addition.exception() is not None]
+
+        if failed_additions:
+
+            executor.shutdown(wait=True, cancel_futures=True)
 
-def upload_highlights_from_book(new_highlights_from_book:pd.DataFrame, page_id:str) -> None:
+            created_titles = [title for addition, title, *_ in additions if not addition.cancelled() and addition.exception() is None]
+            logging.error(f'Adding missing books failed, books created with their highlights: {created_titles}')
+
+            # Raises the error of the failed addition
+            failed_additions[0].result()
+
+        for addition, title, author, rows_matching_book in additions:
+
+            page_id = addition.result()
+
+            logging.info((f'Uploaded {len(rows_matching_book)} highlights to {title}' 
+                            f'ranging from {rows_matching_book.date.min()} to {rows_matching_book.date.max()}'))
+
+            added_books.append({'title':title, 'id':page_id, 'author':author, 'num_highlights':len(rows_matching_book)})
+
+    return added_books
+
+def add_book_with_highlights(title:str, author:str, date:datetime, highlights_from_book:pd.DataFrame) -> str:
     """
-    Uploads highlights from a book to the Notion page.
+    Adds a book to the Notion database, with its highlights already on its page.
+
+    The first `HIGHLIGHTS_ON_CREATION` highlights are added with the page, counted in its number of highlights.
+    The remaining ones are uploaded afterwards, their count only being added once they are all appended, so
+    the number of highlights never counts highlights missing from the page.
 
     Args:
-        new_highlights_from_book (pd.DataFrame): A DataFrame containing highlights from a book.
-        page_id (str): The ID of the Notion page representing the book.
+        title (str): The title of the book.
+        author (str): The author of the book.
+        date (datetime): The date of the book.
+        highlights_from_book (pd.DataFrame): A DataFrame containing highlights from the book.
+
+    Returns:
+        str: The ID of the Notion page created for the book.
     """
-    highlights_to_upload = []
 
-    for highlight_data in new_highlights_from_book.to_dict('records'):
-        pages = (highlight_data.pop('start_page'), highlight_data.pop('end_page'))
-        highlight_data.pop('is_vocabulary')
-        highlight = Highlight(pages=pages, **highlight_data)
-        highlights_to_upload.append(highlight)
+    highlights_on_creation = highlights_from_book.iloc[:HIGHLIGHTS_ON_CREATION]
+    remaining_highlights = highlights_from_book.iloc[HIGHLIGHTS_ON_CREATION:]
+
+    page_id = add_book_to_db(
+            database_id=DATABASE_ID, 
+            title=title, 
+            author=author, 
+            num_highlights=len(highlights_on_creation), 
+            date=date, 
+            api_key=NOTION_API_KEY,
+            notion_version=NOTION_VERSION,
+            children=highlights_to_notion_blocks(highlights_on_creation)
+        )
+
+    if not remaining_highlights.empty:
+        upload_highlights_from_book(
+            new_highlights_from_book=remaining_highlights, 
+            page_id=page_id, 
+            prev_num_highlights=len(highlights_on_creation)
+        )
+
+    return page_id
+
+def highlights_to_notion_blocks(highlights:pd.DataFrame) -> List[Dict]:
+    """
+    Converts highlights to the Notion blocks that represent them on the page of a book.
+
+    Args:
+        highlights (pd.DataFrame): A DataFrame containing highlights.
 
+    Returns:
+        List[Dict]: The blocks of the highlights, in the same order.
+    """
     children = []
 
-    for h in highlights_to_upload:
+    # Rows are read as plain tuples, which avoids building a dict for each of them
+    rows = highlights[['document_name', 'date', 'start_page', 'end_page', 'content', 'author']].itertuples(index=False, name=None)
+
+    for document_name, date, start_page, end_page, content, author in rows:
+
+        highlight = Highlight(document_name=document_name, date=date, pages=(start_page, end_page), content=content, author=author)
 
-        children.extend(h.to_notion_block(structure='quote_paragraph'))
+        children.extend(highlight.to_notion_block(structure='quote_paragraph'))
 
-    content_to_upload = {"children":children}
+    return children
+
+def upload_highlights_from_book(new_highlights_from_book:pd.DataFrame, page_id:str, prev_num_highlights:Optional[int] = None) -> None:
+    """
+    Uploads highlights from a book to the Notion page.
+
+    Args:
+        new_highlights_from_book (pd.DataFrame): A DataFrame containing highlights from a book.
+        page_id (str): The ID of the Notion page representing the book.
+        prev_num_highlights (int, optional): The number of highlights of the book already in Notion.
+            Defaults to None, which retrieves it from the Notion page.
+    """
+    content_to_upload = {"children":highlights_to_notion_blocks(new_highlights_from_book)}
 
     append_content_to_page(
         page_id=page_id, 
@@ -160,7 +324,8 @@ def upload_highlights_from_book(new_highlights_from_book:pd.DataFrame, page_id:s
         page_id=page_id, 
         highlights_added=len(new_highlights_from_book), 
         api_key=NOTION_API_KEY, 
-        notion_version=NOTION_VERSION
+        notion_version=NOTION_VERSION,
+        prev_num_highlights=prev_num_highlights
     )
 
 def upload_new_highlights_to_notion(new_highlights:pd.DataFrame) -> None:
@@ -173,38 +338,80 @@ def upload_new_highlights_to_notion(new_highlights:pd.DataFrame) -> None:
 
     books_in_db = get_books_in_notion_db(database_id=DATABASE_ID, api_key=NOTION_API_KEY, notion_version=NOTION_VERSION)
 
+    # Titles are lowercased once, for finding both the missing books and the pages to upload to
+    books_by_title = index_books_by_title(books_in_db)
+
     print()
     print('Adding missing books to database'.center(60, '-'))
     print()
 
-    add_missing_books_to_db(books_in_db=books_in_db, new_highlights=new_highlights)
+    # The books added already contain their highlights
+    added_books = add_missing_books_to_db(books_by_title=books_by_title, new_highlights=new_highlights)
+    added_titles = {book['title'] for book in added_books}
 
     print()
     print('Updating database'.center(60, '-'))
     print()
 
-    books_in_db = get_books_in_notion_db(database_id=DATABASE_ID, api_key=NOTION_API_KEY, notion_version=NOTION_VERSION)
-
     print('Uploading highlights to Notion'.center(60, '-'))
     print()
     print(f'Highlights from {new_highlights.date.min()} to {new_highlights.date.max()}')
     print()
 
-    for book_title, highlights_from_book in new_highlights.groupby('document_name'):
+    books_to_upload = []
 
-        page_id = [book['id'] for book in books_in_db if book['title']==book_title]
+    # Every book is looked up before any upload starts, so a book missing from the database uploads nothing.
+    # Books are taken in the order they first appear, sorting them would only add a pass
+    for book_title, highlights_from_book in new_highlights.groupby('document_name', sort=False):
 
-        if page_id:
-            page_id = page_id[0]
-        else:
+        if book_title in added_titles:
+            continue
+
+        book = books_by_title.get(book_title.lower())
+
+        if book is None:
             raise ValueError()
-        
-        print(f'\t- Uploading {len(highlights_from_book)} highlights to {book_title}...')
 
-        upload_highlights_from_book(new_highlights_from_book=highlights_from_book, page_id=page_id)
+        books_to_upload.append((book_title, highlights_from_book, book))
+
+    # Each book is a separate Notion page, so books are uploaded concurrently
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+
+        uploads = []
+
+        for book_title, highlights_from_book, book in books_to_upload:
+            
+            print(f'\t- Uploading {len(highlights_from_book)} highlights to {book_title}...')
+
+            upload = executor.submit(
+                upload_highlights_from_book,
+                new_highlights_from_book=highlights_from_book, 
+                page_id=book['id'], 
+                prev_num_highlights=book['num_highlights']
+            )
+
+            uploads.append((upload, book_title, highlights_from_book))
+
+        # The highlights of a failed run are all uploaded again by the next one. So on the first failure,
+        # the books not started yet are cancelled instead of also being uploaded
+        wait([upload for upload, *_ in uploads], return_when=FIRST_EXCEPTION)
+
+        failed_uploads = [upload for upload, *_ in uploads if upload.done() and upload.exception() is not None]
+
+        if failed_uploads:
 
-        logging.info((f'Uploaded {len(highlights_from_book)} highlights to {book_title}' 
-                        f'ranging from {highlights_from_book.date.min()} to {highlights_from_book.date.max()}'))
+            executor.shutdown(wait=True, cancel_futures=True)
+
+            uploaded_titles = [book_title for upload, book_title, _ in uploads if not upload.cancelled() and upload.exception() is None]
+            logging.error(f'Uploading highlights failed, books with their highlights uploaded: {uploaded_titles}')
+
+            # Raises the error of the failed upload
+            failed_uploads[0].result()
+
+        for upload, book_title, highlights_from_book in uploads:
+
+            logging.info((f'Uploaded {len(highlights_from_book)} highlights to {book_title}' 
+                            f'ranging from {highlights_from_book.date.min()} to {highlights_from_book.date.max()}'))
         
     logging.info(f'Finished uploading highlights. Date from last highlight is {new_highlights.date.max()}')
             
@@ -223,14 +430,15 @@ def update_vocabulary_db(new_vocabulary:pd.DataFrame) -> None:
 
     starting_num_words = len(new_vocabulary)
     new_vocabulary = new_vocabulary[['content', 'date']]
-    empty = new_vocabulary.content.str.strip()
-    empty = (empty.isna())|(empty=='')
+    not_empty = new_vocabulary.content.fillna('').str.strip().astype(bool)
     
-    new_vocabulary = new_vocabulary.loc[~empty]
+    new_vocabulary = new_vocabulary.loc[not_empty]
     end_num_words = len(new_vocabulary)
     print(f'\t- Dropped {starting_num_words - end_num_words} words.')
 
-    new_vocabulary.to_csv('vocabulary.csv', mode='a', index=False, header=False)
+    with open('vocabulary.csv', 'a', newline='', encoding='utf-8') as vocabulary_file:
+        writer = csv.writer(vocabulary_file, lineterminator=os.linesep)
+        writer.writerows(new_vocabulary.itertuples(index=False, name=None))
     print(f'\t- Added {len(new_vocabulary)} words of vocabulary to CSV')
 
     logging.info(f'Finished updating vocabulary. Date from last vocabulary word is {new_vocabulary.date.max()}')
@@ -250,16 +458,20 @@ def select_new_highlights_and_vocabulary(df:pd.DataFrame, last_highlight_date:da
         Tuple[pd.DataFrame, pd.DataFrame]: A tuple containing two DataFrames, one for new highlights and one for new vocabulary.
     """
 
+    # The selections are only read afterwards, so they are not copied
+
     if last_highlight_date :
 
         # Only consider the highlights done after the date 
         # of the last highlight logged into the DB
 
-        new_highlights = df.loc[(df.date>last_highlight_date) & ~(df.is_vocabulary)].copy()
-        new_vocabulary = df.loc[(df.date>last_highlight_date) & (df.is_vocabulary)].copy()
+        is_new = df.date>last_highlight_date
+
+        new_highlights = df.loc[is_new & ~(df.is_vocabulary)]
+        new_vocabulary = df.loc[is_new & (df.is_vocabulary)]
     else:
-        new_highlights  = df[~df.is_vocabulary].copy()
-        new_vocabulary = df[df.is_vocabulary].copy()
+        new_highlights  = df[~df.is_vocabulary]
+        new_vocabulary = df[df.is_vocabulary]
 
     return new_highlights, new_vocabulary
 
@@ -3,7 +3,7 @@ This module contains utility functions for reading file contents, extracting uni
 and extracting dates from lines of text.
 """
 
-from typing import List, Any
+from typing import List, Any, Iterator
 from datetime import datetime
 import re
 import pandas as pd
@@ -26,6 +26,36 @@ def read_file_content(filename:str) -> str:
     return text
 
 
+def iter_file_records(filename:str, delimiter:str) -> Iterator[str]:
+    """
+    Lazily reads the records of a text file separated by delimiter lines.
+
+    The file is streamed line by line, so only the record being read is kept in memory.
+
+    Args:
+        filename (str): The name of the file to read. Should be in the same directory.
+        delimiter (str): The text starting the lines that separate two records.
+
+    Yields:
+        str: The text of each record, without the delimiter line.
+    """
+
+    record_lines = []
+
+    with open(filename, 'r', buffering=1<<20) as file:
+
+        for line in file:
+
+            if line.startswith(delimiter):
+                yield ''.join(record_lines)
+                record_lines.clear()
+            else:
+                record_lines.append(line)
+
+    if record_lines:
+        yield ''.join(record_lines)
+
+
 def get_unique_column_value(partial_df:pd.DataFrame, col_name:str) -> Any:
     """
     Retrieves the unique value from a column in a Pandas DataFrame subset.
@@ -41,8 +71,11 @@ def get_unique_column_value(partial_df:pd.DataFrame, col_name:str) -> Any:
         AssertionError: If the column contains more than one unique value.
     """
 
+    # Same check as nunique()==1, comparing to the first value instead of hashing every value
+    values = partial_df[col_name].dropna().values
+
     try:
-        assert partial_df[col_name].nunique()==1, f'More than one different value for {col_name}'
+        assert len(values) > 0 and (values == values[0]).all(), f'More than one different value for {col_name}'
     except AssertionError as e:
         print(partial_df[col_name])
         print(partial_df[col_name].unique())
@@ -2,7 +2,7 @@
 This module contains functions and classes for validating input data.
 """
 
-from typing import List, TypeVar
+from typing import List, TypeVar, Union, Pattern
 import re
 
 T = TypeVar('T')
@@ -24,20 +24,24 @@ class PatternError(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
 
-def check_text_format(text_to_check:str, expected_pattern:str) -> None:
+def check_text_format(text_to_check:str, expected_pattern:Union[str, Pattern[str]]) -> None:
     """
-    Checks if a text matches the expected pattern using regular expressions.
+    Checks if a whole text matches the expected pattern using regular expressions.
 
     Args:
         text_to_check (str): The text to be checked.
-        expected_pattern (str): The regular expression pattern representing the expected format.
+        expected_pattern (str or re.Pattern): The regular expression pattern representing the expected format.
+            A precompiled pattern is used as is.
 
     Raises:
         PatternError: If the text does not match the expected pattern.
     """
 
-    if not re.match(expected_pattern, text_to_check):
-        raise PatternError(f'{text_to_check} does not match format expected : {expected_pattern}')
+    if isinstance(expected_pattern, str):
+        expected_pattern = re.compile(expected_pattern)
+
+    if not expected_pattern.fullmatch(text_to_check):
+        raise PatternError(f'{text_to_check} does not match format expected : {expected_pattern.pattern}')
 
 def check_single_match(
         matches:List[T], 